@@ -0,0 +1,88 @@
+"""
+Measures the throughput in files/s of tidy_xml.py on a generated corpus
+of small xml-files, processing the files one at a time and in batches
+(BATCH_SMALL_FILES_MAX_KB), and checks that the output is identical.
+
+Usage: python benchmark.py [number of files] [number of runs]
+"""
+
+import contextlib
+import filecmp
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+import tidy_xml
+
+
+# Paragraphs in the style of Transkribus and TEIGarage Conversion
+# exports, of which the generated files are composed
+PARAGRAPHS = [
+	'<p facs="#f1"><lb facs="#l1" n="1"/>Det var en <hi rend="italic">vacker</hi> dag, och han gick ut-\n<lb facs="#l2" n="2"/>för att se 12000 fåglar "flyga".</p>',
+	'<p rend="Body"><hi rend="Body">Brevet skrevs 1845</hi> i Helsingfors - se s. 3 ...</p>',
+	'<p><hi rend="bold">Första</hi><hi rend="bold"> delen</hi> av texten <seg rend="italic">med kursiv</seg>.</p>',
+	'<p>En fotnot<note n="1" place="foot"><p rend="footnote text"> Se brevet.</p></note> och en <choice><abbr>Fr.</abbr><expan/></choice></p>',
+	'<p rend="Quote">Ett citat i ett eget stycke.</p>',
+	'<table rend="frame"><row><cell style="x" rend="botBorder">1 500</cell><cell>2 000</cell></row></table>',
+	'<list type="ordered" rend="numbered"><item>Ett</item><item>Två</item></list>',
+	'<p><pb facs="#f2" n="2" xml:id="pb2"/>Text på nästa sida med ¬ tecken och <anchor xml:id="a1"/>ankare.</p>'
+]
+
+
+def write_corpus(folder, file_count: int):
+	random.seed(1)
+	os.makedirs(os.path.join(folder, tidy_xml.SOURCE_FOLDER))
+	for n in range(file_count):
+		body = "\n".join(random.choice(PARAGRAPHS) for _ in range(random.randint(2, 12)))
+		filepath = os.path.join(folder, tidy_xml.SOURCE_FOLDER, f"doc{n:04d}.xml")
+		with open(filepath, "w", encoding="utf-8") as output_file:
+			output_file.write(f'<?xml version="1.0" encoding="utf-8"?>\n<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body>\n{body}\n</body></text></TEI>\n')
+
+
+# run tidy_xml.main() with the given batch size limit and return the
+# time it took in seconds
+def run_tidy_xml(output_folder, batch_max_kb: int) -> float:
+	tidy_xml.OUTPUT_FOLDER = output_folder
+	tidy_xml.BATCH_SMALL_FILES_MAX_KB = batch_max_kb
+	start = time.perf_counter()
+	with contextlib.redirect_stdout(io.StringIO()):
+		tidy_xml.main()
+	return time.perf_counter() - start
+
+
+def main():
+	file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+	tidy_xml.EXE_MODE = False
+
+	with tempfile.TemporaryDirectory() as folder:
+		write_corpus(folder, file_count)
+		os.chdir(folder)
+		results = {}
+		for name, batch_max_kb in [("one file at a time", 0), ("in batches", 64)]:
+			# Write the output to an empty folder on each run, so that
+			# every run writes all files
+			times = []
+			for run in range(runs):
+				times.append(run_tidy_xml(f"{name}_{run}", batch_max_kb))
+			results[name] = min(times)
+
+		_, mismatches, errors = filecmp.cmpfiles(
+			"one file at a time_0", "in batches_0", os.listdir(tidy_xml.SOURCE_FOLDER), shallow=False
+		)
+		os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+	print(f"{file_count} files, best of {runs} runs:")
+	for name, seconds in results.items():
+		print(f"  {name}: {file_count / seconds:.0f} files/s")
+	if mismatches or errors:
+		print(f"Error: the output differs for {len(mismatches) + len(errors)} files.")
+		sys.exit(1)
+	print("The output is identical.")
+
+
+if __name__ == "__main__":
+	main()
@@ -1,7 +1,24 @@
+import bisect
+import csv
+import hashlib
+import heapq
 import json
+import multiprocessing
 import os
+import pathlib
 import re
+import shutil
+import sqlite3
 import sys
+import tempfile
+import tracemalloc
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows, where the memory limit of worker
+	# processes is not supported
+	resource = None
 
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
@@ -20,8 +37,35 @@ DEBUG = False
 
 SOURCE_FOLDER = "bad_xml"
 OUTPUT_FOLDER = "good_xml"
+QUARANTINE_FOLDER = "quarantine_xml"
+
+# Exit code of a worker process which has run out of memory
+MEMORY_LIMIT_EXIT_CODE = 3
+
+# Minimum size of input files whose peak memory is included in the
+# reported maximum peak memory per input MB, since the fixed memory
+# use of tiny files would dominate the ratio
+PEAK_MEMORY_MIN_INPUT_KB = 100
+
+# Maximum number of small files transformed together in one batch
+SMALL_FILE_BATCH_SIZE = 50
+
+# XML declaration at the start of XML documents serialized by BeautifulSoup
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
 ABBR_DICT_FILEPATH = "dictionaries/abbr_dictionary.json"
 
+# On-disk index of the abbreviation dictionaries, which is rebuilt
+# when any of the dictionary files changes, and an optional JSON file
+# with a list of abbreviations that are not expanded when untagged
+ABBR_INDEX_FILEPATH = "dictionaries/abbr_index.sqlite"
+ABBR_EXCLUSIONS_FILEPATH = "dictionaries/abbr_exclusions.json"
+
+# Version of the format of the index, which is rebuilt when it changes
+ABBR_INDEX_VERSION = 2
+
+# Maximum number of abbreviations looked up in the index in one query
+ABBR_LOOKUP_CHUNK_SIZE = 500
+
 # Load parameters from .env file
 load_dotenv()
 
@@ -62,13 +106,111 @@ if os.getenv("CHECK_UNTAGGED_ABBREVIATIONS") == "True":
 else:
 	CHECK_UNTAGGED_ABBREVIATIONS = False
 
+# comma-separated list of abbreviation dictionary files in order of
+# priority: if an abbreviation is in several dictionaries, the
+# expansion in the first one is used
+if os.getenv("ABBR_DICTIONARIES") != "" and os.getenv("ABBR_DICTIONARIES") is not None:
+	ABBR_DICTIONARIES = [filepath.strip() for filepath in os.getenv("ABBR_DICTIONARIES").split(",") if filepath.strip() != ""]
+else:
+	ABBR_DICTIONARIES = [ABBR_DICT_FILEPATH]
+
 if os.getenv("PRESERVE_LB_TAGS") == "True":
 	PRESERVE_LB_TAGS = True
 else:
 	PRESERVE_LB_TAGS = False
 
+# if set: count how often each named rule matches and how much
+# it changes the length of the xml, and save the counts to this
+# file (CSV if the file extension is .csv, otherwise JSON)
+if os.getenv("RULE_TELEMETRY_FILEPATH") != "" and os.getenv("RULE_TELEMETRY_FILEPATH") is not None:
+	RULE_TELEMETRY_FILEPATH = os.getenv("RULE_TELEMETRY_FILEPATH")
+else:
+	RULE_TELEMETRY_FILEPATH = None
+
+# if True: measure the peak memory used while processing each file
+# and report it relative to the size of the input file
+if os.getenv("REPORT_PEAK_MEMORY") == "True":
+	REPORT_PEAK_MEMORY = True
+else:
+	REPORT_PEAK_MEMORY = False
+
+# per-file limits for the wall-clock time in seconds and the memory
+# in megabytes. If either is set (above 0), files are processed in a
+# separate worker process, and files which exceed a limit are moved
+# to the quarantine folder. The memory limit is not supported on Windows.
+if os.getenv("FILE_TIMEOUT_SECONDS") is not None and os.getenv("FILE_TIMEOUT_SECONDS").isdigit():
+	FILE_TIMEOUT_SECONDS = int(os.getenv("FILE_TIMEOUT_SECONDS"))
+else:
+	FILE_TIMEOUT_SECONDS = 0
+
+if os.getenv("FILE_MEMORY_LIMIT_MB") is not None and os.getenv("FILE_MEMORY_LIMIT_MB").isdigit():
+	FILE_MEMORY_LIMIT_MB = int(os.getenv("FILE_MEMORY_LIMIT_MB"))
+else:
+	FILE_MEMORY_LIMIT_MB = 0
+
+# if set (above 0): files of at most this size in kilobytes are
+# transformed together in batches, which reduces the fixed cost of
+# processing many small files. The output is the same as when
+# processing the files one at a time.
+if os.getenv("BATCH_SMALL_FILES_MAX_KB") is not None and os.getenv("BATCH_SMALL_FILES_MAX_KB").isdigit():
+	BATCH_SMALL_FILES_MAX_KB = int(os.getenv("BATCH_SMALL_FILES_MAX_KB"))
+else:
+	BATCH_SMALL_FILES_MAX_KB = 0
+
+# name of the rule profile, which determines the rule stages that
+# are run, and the path to an optional JSON file with custom profiles
+if os.getenv("RULE_PROFILE") != "" and os.getenv("RULE_PROFILE") is not None:
+	RULE_PROFILE = os.getenv("RULE_PROFILE")
+else:
+	RULE_PROFILE = "full"
+
+RULE_PROFILES_FILEPATH = "rule_profiles.json"
+
+# Stages of rules which can be enabled or disabled with rule profiles.
+# Rules which are not part of any stage are always run.
+RULE_STAGES = [
+	"transkribus-lines",
+	"poetry",
+	"teigarage-styles",
+	"typography",
+	"footnote-asterisk",
+	"number-normalization",
+	"untagged-abbreviations"
+]
+
+# Built-in rule profiles and the stages they enable. The stages
+# number-normalization and untagged-abbreviations are additionally
+# controlled by NORMALIZE_LARGE_NUMBERS and CHECK_UNTAGGED_ABBREVIATIONS.
+RULE_PROFILES = {
+	"full": RULE_STAGES,
+	"transkribus-prose": [
+		"transkribus-lines", "typography", "footnote-asterisk",
+		"number-normalization", "untagged-abbreviations"
+	],
+	"transkribus-poetry": [
+		"poetry", "typography", "footnote-asterisk",
+		"number-normalization", "untagged-abbreviations"
+	],
+	"teigarage": [
+		"teigarage-styles", "typography", "footnote-asterisk",
+		"number-normalization", "untagged-abbreviations"
+	]
+}
+
+# RuleTelemetry instance collecting rule counts, None when disabled
+rule_telemetry = None
+
+# Rule stages enabled by the compiled rule profile
+rule_stages = frozenset(RULE_STAGES)
+
+# Shared character array in which a worker process records the stage
+# the current file is in, None when not running in a worker process
+current_stage = None
+
 
 def main():
+	global rule_telemetry, rule_stages
+
 	if EXE_MODE:
 		print_exe_header()
 
@@ -90,7 +232,23 @@ def main():
 			input("\nPress Enter to close this window ")
 		sys.exit(1)
 
-	abbr_dictionary = read_dict_from_file(ABBR_DICT_FILEPATH)
+	try:
+		rule_profiles = read_rule_profiles(RULE_PROFILES_FILEPATH)
+		rule_stages = compile_rule_profile(RULE_PROFILE, rule_profiles)
+	except ValueError as error:
+		print(f"\nError: {error}")
+		if EXE_MODE:
+			input("\nPress Enter to close this window ")
+		sys.exit(1)
+	print(f"\nRule profile: {RULE_PROFILE}")
+
+	try:
+		abbr_dictionary = open_abbreviation_index(ABBR_DICTIONARIES, ABBR_INDEX_FILEPATH, ABBR_EXCLUSIONS_FILEPATH)
+	except ValueError as error:
+		print(f"\nError: {error}")
+		if EXE_MODE:
+			input("\nPress Enter to close this window ")
+		sys.exit(1)
 
 	if EXE_MODE:
 		print()
@@ -99,27 +257,196 @@ def main():
 	file_list_len = len(file_list)
 	print(f"\nProcessing {file_list_len} XML-files:")
 
+	if RULE_TELEMETRY_FILEPATH is not None:
+		rule_telemetry = RuleTelemetry()
+
+	# Counts of output files by write status
+	write_counts = {"written": 0, "unchanged": 0, "failed": 0, "quarantined": 0}
+
+	max_peak_mb = 0.0
+	max_peak_file = None
+	max_peak_per_input_mb = None
+	worker = None
+	if FILE_TIMEOUT_SECONDS > 0 or FILE_MEMORY_LIMIT_MB > 0:
+		if FILE_MEMORY_LIMIT_MB > 0 and resource is None:
+			print("Info: The memory limit for files is not supported on this platform and will not be applied.")
+		worker = GuardedWorker(abbr_dictionary, FILE_TIMEOUT_SECONDS, FILE_MEMORY_LIMIT_MB)
+	elif REPORT_PEAK_MEMORY:
+		tracemalloc.start()
+
+	if BATCH_SMALL_FILES_MAX_KB > 0 and worker is None and not REPORT_PEAK_MEMORY:
+		file_batches = get_file_batches(file_list, BATCH_SMALL_FILES_MAX_KB, SMALL_FILE_BATCH_SIZE)
+	else:
+		if BATCH_SMALL_FILES_MAX_KB > 0:
+			print("Info: Small files are not processed in batches when file limits or peak memory reporting are set.")
+		file_batches = [[file] for file in file_list]
+
 	n: int = 0
-	for file in file_list:
-		n += 1
-		print(f"{n}/{file_list_len}: ", flush=True, end="")
+	for files in file_batches:
+		if len(files) > 1:
+			results = run_batch(files, abbr_dictionary, n + 1)
+		else:
+			print(f"{n + 1}/{file_list_len}: ", flush=True, end="")
+			if worker is not None:
+				results = [worker.run_file(files[0], n + 1)]
+			else:
+				results = [run_file(files[0], abbr_dictionary, n + 1)]
+
+		for file, (status, detail, stage, peak_mb, file_stats) in zip(files, results):
+			n += 1
+			if len(files) > 1:
+				print(f"{n}/{file_list_len}: ", end="")
+
+			if file_stats is not None:
+				rule_telemetry.file_stats[file] = file_stats
+
+			if peak_mb is not None:
+				input_size = os.path.getsize(os.path.join(SOURCE_FOLDER, file))
+				input_mb = max(input_size, 1) / 1024 / 1024
+				if peak_mb > max_peak_mb or max_peak_file is None:
+					max_peak_mb = peak_mb
+					max_peak_file = file
+				if input_size >= PEAK_MEMORY_MIN_INPUT_KB * 1024:
+					max_peak_per_input_mb = max(max_peak_per_input_mb or 0.0, peak_mb / input_mb)
+				print(f"Peak memory {peak_mb:.1f} MB ({peak_mb / input_mb:.1f} MB per input MB), ", end="")
+
+			if status == "quarantined":
+				try:
+					quarantine_file(file, detail, stage)
+				except OSError as error:
+					status = "failed"
+					detail = f"{detail} in stage {stage}, and the file could not be quarantined: {error}"
+
+			write_counts[status] += 1
+			if status == "failed":
+				print(f"Error: Could not process {file}: {detail}")
+			elif status == "quarantined":
+				print(f"Quarantined {QUARANTINE_FOLDER}/{file}: {detail} in stage {stage}")
+			elif status == "unchanged":
+				print(f"Unchanged {OUTPUT_FOLDER}/{file}")
+			else:
+				print(f"Created {OUTPUT_FOLDER}/{file}")
 
-		old_soup: BeautifulSoup = read_xml(file)
-		new_soup: BeautifulSoup = transform_xml(old_soup, abbr_dictionary)
+	if worker is not None:
+		worker.stop()
 
-		if DEBUG:
-			write_to_file(str(new_soup), f"parsing_temp_{n}.xml")
+	print(f"\nSuccessfully tidied {file_list_len - write_counts['failed'] - write_counts['quarantined']} XML-files.")
+	print(f"Written: {write_counts['written']}, unchanged: {write_counts['unchanged']}, failed: {write_counts['failed']}, quarantined: {write_counts['quarantined']}\n")
 
-		tidy_xml_string: str = tidy_up_xml(str(new_soup), abbr_dictionary, n)
-		write_to_file(tidy_xml_string, file)
-		print(f"Created {OUTPUT_FOLDER}/{file}")
+	if REPORT_PEAK_MEMORY:
+		if worker is None:
+			tracemalloc.stop()
+		if max_peak_file is not None:
+			print(f"Maximum peak memory: {max_peak_mb:.1f} MB ({max_peak_file})")
+		if max_peak_per_input_mb is not None:
+			print(f"Maximum peak memory per input MB of files of at least {PEAK_MEMORY_MIN_INPUT_KB} KB: {max_peak_per_input_mb:.1f} MB")
+		print()
 
-	print(f"\nSuccessfully tidied {len(file_list)} XML-files.\n")
+	if rule_telemetry is not None:
+		rule_telemetry.export(RULE_TELEMETRY_FILEPATH)
+		print(f"Saved rule telemetry to {RULE_TELEMETRY_FILEPATH}\n")
 
 	if EXE_MODE:
 		input("Press Enter to close this window ")
 
 
+# read, transform, tidy and write one file. Returns a tuple of the
+# write status ("written", "unchanged" or "failed"), an error message,
+# the stage of a quarantined file, the peak memory in MB used for the file if
+# REPORT_PEAK_MEMORY is set and the rule telemetry counts of the file
+# if telemetry is enabled and the file is processed in a worker process.
+def run_file(file, abbr_dictionary, file_n: int) -> tuple:
+	if rule_telemetry is not None:
+		rule_telemetry.start_file(file)
+	if REPORT_PEAK_MEMORY:
+		tracemalloc.reset_peak()
+		memory_at_start = tracemalloc.get_traced_memory()[0]
+
+	try:
+		set_stage("read_xml")
+		old_soup: BeautifulSoup = read_xml(file)
+		set_stage("transform_xml")
+		new_soup: BeautifulSoup = transform_xml(old_soup, abbr_dictionary)
+		set_stage("serialize_soup")
+		xml_string: str = serialize_soup(old_soup, new_soup, file_n)
+		del old_soup, new_soup
+
+		set_stage("tidy_up_xml")
+		tidy_xml_string: str = tidy_up_xml(xml_string, abbr_dictionary, file_n)
+		del xml_string
+
+		set_stage("write_to_file")
+		status = write_to_file(tidy_xml_string, file)
+	except OSError as error:
+		return ("failed", str(error), None, None, None)
+
+	if REPORT_PEAK_MEMORY:
+		peak_mb = (tracemalloc.get_traced_memory()[1] - memory_at_start) / 1024 / 1024
+	else:
+		peak_mb = None
+	return (status, "", None, peak_mb, None)
+
+
+# transform the small files together in one batch, then serialize,
+# tidy and write each file separately. Returns a list with a tuple
+# like the one returned by run_file() for each file.
+def run_batch(files, abbr_dictionary, first_file_n: int) -> list:
+	results = {}
+	old_soups = []
+	for file in files:
+		try:
+			old_soups.append((file, read_xml(file)))
+		except OSError as error:
+			results[file] = ("failed", str(error), None, None, None)
+
+	if rule_telemetry is not None:
+		# Rules in transform_xml are counted for the batch as a whole,
+		# and only included in the totals since they can't be
+		# attributed to the files of the batch
+		rule_telemetry.start_file("")
+	roots = transform_xml_batch([old_soup for _, old_soup in old_soups], abbr_dictionary)
+
+	for (file, old_soup), root in zip(old_soups, roots):
+		file_n = first_file_n + files.index(file)
+		xml_string: str = serialize_root(old_soup, root, file_n)
+		del old_soup, root
+
+		if rule_telemetry is not None:
+			rule_telemetry.start_file(file)
+		tidy_xml_string: str = tidy_up_xml(xml_string, abbr_dictionary, file_n)
+		del xml_string
+
+		try:
+			status = write_to_file(tidy_xml_string, file)
+		except OSError as error:
+			results[file] = ("failed", str(error), None, None, None)
+			continue
+		results[file] = (status, "", None, None, None)
+
+	return [results[file] for file in files]
+
+
+# group consecutive files of at most max_kb kilobytes into batches of
+# at most batch_size files, other files are put in batches of their own
+def get_file_batches(file_list, max_kb: int, batch_size: int) -> list:
+	file_batches = []
+	small_files = []
+	for file in file_list:
+		if os.path.getsize(os.path.join(SOURCE_FOLDER, file)) <= max_kb * 1024:
+			small_files.append(file)
+			if len(small_files) == batch_size:
+				file_batches.append(small_files)
+				small_files = []
+		else:
+			if small_files:
+				file_batches.append(small_files)
+				small_files = []
+			file_batches.append([file])
+	if small_files:
+		file_batches.append(small_files)
+	return file_batches
+
+
 # loop through xml source files in folder and append to list
 def get_source_file_paths():
 	file_list = []
@@ -137,51 +464,230 @@ def read_xml(filename) -> BeautifulSoup:
 	return old_soup
 
 
-# get dictionary content from file
+# read a dictionary of abbreviations and their expansions, raises
+# ValueError if the file isn't a valid dictionary
 def read_dict_from_file(filename):
 	try:
 		with open(filename, encoding="utf-8-sig") as source_file:
 			json_content = json.load(source_file)
-			return json_content
-	except FileNotFoundError as error:
-		print(f"Info: Dictionary file for abbreviations not found in path\n      '{ABBR_DICT_FILEPATH}'.")
+	except json.JSONDecodeError as error:
+		raise ValueError(f"The dictionary file '{filename}' is not valid JSON: {error}.")
+	if not isinstance(json_content, dict) or not all(isinstance(expansion, str) for expansion in json_content.values()):
+		raise ValueError(f"The dictionary file '{filename}' must contain abbreviations and their expansions as key–value pairs.")
+	return json_content
+
+
+# get the abbreviations which are not expanded when untagged: the list
+# in the exclusions file if there is one, otherwise the built-in list.
+# Raises ValueError if the file isn't a valid list.
+def read_abbr_exclusions(filename) -> frozenset:
+	try:
+		with open(filename, encoding="utf-8-sig") as source_file:
+			exclusions = json.load(source_file)
+	except FileNotFoundError:
+		return frozenset(DO_NOT_EXPAND)
+	except json.JSONDecodeError as error:
+		raise ValueError(f"The exclusions file '{filename}' is not valid JSON: {error}.")
+	if not isinstance(exclusions, list) or not all(isinstance(abbreviation, str) for abbreviation in exclusions):
+		raise ValueError(f"The exclusions file '{filename}' must contain a list of abbreviations.")
+	return frozenset(exclusions)
+
+
+# open the index of the abbreviation dictionaries, and build it first
+# if it doesn't exist or the dictionary files have changed since it
+# was built. Raises ValueError if a file isn't valid or the index
+# can't be built.
+def open_abbreviation_index(dict_filepaths, index_filepath, exclusions_filepath):
+	exclusions = read_abbr_exclusions(exclusions_filepath)
+	existing_filepaths = []
+	for filepath in dict_filepaths:
+		if os.path.isfile(filepath):
+			existing_filepaths.append(filepath)
+		else:
+			print(f"Info: Dictionary file for abbreviations not found in path\n      '{filepath}'.")
+	if len(existing_filepaths) == 0:
 		print("      Expansions to unexpanded abbreviations will not be added.")
+		return AbbreviationIndex(None, exclusions)
+
+	# the index is identified by its format version and the paths,
+	# sizes and modification times of the dictionary files in order
+	# of priority
+	signature = json.dumps([ABBR_INDEX_VERSION] + [
+		[os.path.abspath(filepath), os.path.getsize(filepath), os.stat(filepath).st_mtime_ns]
+		for filepath in existing_filepaths
+	])
+	if read_index_meta(index_filepath).get("signature") != signature:
+		print("Building index of abbreviation dictionaries ...")
+		build_abbreviation_index(existing_filepaths, index_filepath, signature)
+	return AbbreviationIndex(index_filepath, exclusions)
+
+
+def read_index_meta(index_filepath) -> dict:
+	if not os.path.isfile(index_filepath):
+		return {}
+	try:
+		connection = sqlite3.connect(pathlib.Path(index_filepath).resolve().as_uri() + "?mode=ro", uri=True)
+		try:
+			return dict(connection.execute("SELECT key, value FROM meta").fetchall())
+		finally:
+			connection.close()
+	except sqlite3.Error:
 		return {}
 
 
+# build the index in a temporary file which then replaces the old
+# index. Only one dictionary at a time is held in memory. Each
+# abbreviation gets the expansion and position of the dictionary
+# with the highest priority it is in, and the position determines
+# the order in which untagged abbreviations are searched for. The
+# maximum length of the abbreviations with the same head limits the
+# parts of the text that are looked up as possible abbreviations.
+def build_abbreviation_index(dict_filepaths, index_filepath, signature):
+	temp_filepath = None
+	try:
+		index_folder = os.path.dirname(os.path.abspath(index_filepath))
+		os.makedirs(index_folder, exist_ok=True)
+		file_descriptor, temp_filepath = tempfile.mkstemp(dir=index_folder, suffix=".tmp")
+		os.close(file_descriptor)
+		connection = sqlite3.connect(temp_filepath)
+		try:
+			connection.create_function("abbreviation_head", 1, abbreviation_head, deterministic=True)
+			connection.execute("CREATE TABLE abbreviations (abbreviation TEXT PRIMARY KEY, expansion TEXT NOT NULL, position INTEGER NOT NULL) WITHOUT ROWID")
+			connection.execute("CREATE TABLE heads (head TEXT PRIMARY KEY, max_length INTEGER NOT NULL) WITHOUT ROWID")
+			connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+			position = 0
+			for filepath in dict_filepaths:
+				dictionary = read_dict_from_file(filepath)
+				connection.executemany(
+					"INSERT OR IGNORE INTO abbreviations VALUES (?, ?, ?)",
+					((abbreviation, expansion, position + n) for n, (abbreviation, expansion) in enumerate(dictionary.items()))
+				)
+				position += len(dictionary)
+				del dictionary
+			connection.execute("INSERT INTO heads SELECT abbreviation_head(abbreviation), max(length(abbreviation)) FROM abbreviations GROUP BY 1")
+			connection.execute("INSERT INTO meta VALUES (?, ?)", ("signature", signature))
+			connection.commit()
+		finally:
+			connection.close()
+		os.replace(temp_filepath, index_filepath)
+	except (OSError, sqlite3.Error) as error:
+		raise ValueError(f"The index of abbreviation dictionaries could not be built in '{index_filepath}': {error}.")
+	finally:
+		if temp_filepath is not None and os.path.exists(temp_filepath):
+			os.remove(temp_filepath)
+
+
+# get the built-in rule profiles together with any custom profiles
+# from file, which contains profile names and lists of stages as
+# key–value pairs in JSON format. Raises ValueError if the file
+# isn't valid.
+def read_rule_profiles(filename):
+	rule_profiles = dict(RULE_PROFILES)
+	try:
+		with open(filename, encoding="utf-8-sig") as source_file:
+			custom_profiles = json.load(source_file)
+	except FileNotFoundError:
+		return rule_profiles
+	except json.JSONDecodeError as error:
+		raise ValueError(f"The rule profiles file '{filename}' is not valid JSON: {error}.")
+	if not isinstance(custom_profiles, dict) or not all(isinstance(stages, list) for stages in custom_profiles.values()):
+		raise ValueError(f"The rule profiles file '{filename}' must contain profile names and lists of stage names as key–value pairs.")
+	built_in_names = [name for name in custom_profiles if name in RULE_PROFILES]
+	if built_in_names:
+		raise ValueError(f"The rule profiles file '{filename}' redefines the built-in profiles {', '.join(built_in_names)}. Please give custom profiles other names.")
+	rule_profiles.update(custom_profiles)
+	return rule_profiles
+
+
+# get the set of rule stages enabled by the named profile, raises
+# ValueError if the profile or any of its stages is unknown
+def compile_rule_profile(profile_name, rule_profiles) -> frozenset:
+	if profile_name not in rule_profiles:
+		raise ValueError(f"Unknown rule profile '{profile_name}'. Available profiles: {', '.join(rule_profiles)}.")
+	stages = rule_profiles[profile_name]
+	if isinstance(stages, str) or not all(isinstance(stage, str) for stage in stages):
+		raise ValueError(f"The stages of rule profile '{profile_name}' must be a list of stage names.")
+	unknown_stages = [stage for stage in stages if stage not in RULE_STAGES]
+	if unknown_stages:
+		raise ValueError(f"Unknown stages {', '.join(unknown_stages)} in rule profile '{profile_name}'. Available stages: {', '.join(RULE_STAGES)}.")
+	return frozenset(stages)
+
+
 def transform_xml(old_soup: BeautifulSoup, abbr_dictionary) -> BeautifulSoup:
 	"""Transforms certain elements, attributes and values in old_soup, which is a BeautifulSoup object, and returns the transformed BeautifulSoup object."""
 	# Create a new soup with <root>
-	new_soup: BeautifulSoup = BeautifulSoup("<root></root>", "xml")
+	new_soup: BeautifulSoup = BeautifulSoup("", "xml")
+	new_soup.append(extract_root(old_soup))
+
+	transform_elements(new_soup, abbr_dictionary)
+
+	if "teigarage-styles" in rule_stages:
+		# Combine sibling <quote type="block"> elements
+		new_soup = combine_quote_blocks(new_soup)
+
+	return new_soup
 
+
+def transform_xml_batch(old_soups: list, abbr_dictionary) -> list:
+	"""Transforms the documents in old_soups, which is a list of BeautifulSoup objects, together in one new soup, so that each rule searches all documents at once. Returns the list of transformed <root> elements, one for each document."""
+	new_soup: BeautifulSoup = BeautifulSoup("", "xml")
+	roots = []
+	for old_soup in old_soups:
+		root = extract_root(old_soup)
+		new_soup.append(root)
+		roots.append(root)
+
+	transform_elements(new_soup, abbr_dictionary)
+
+	if "teigarage-styles" in rule_stages:
+		# Combine sibling <quote type="block"> elements separately
+		# in each document
+		for root in roots:
+			combine_quote_blocks(root)
+
+	return roots
+
+
+def extract_root(old_soup: BeautifulSoup):
+	"""Extracts the <body> element, or the root element if there is no <body>, from old_soup and returns it renamed to <root>."""
 	# Find the <body> or root element
 	xml_body = old_soup.find("body")
 	if xml_body is None:
 		# No <body> element in XML document, get root element instead
-		old_root = old_soup.find()
-		old_root.name = "body"
-		new_soup.root.append(old_root)
-	else:
-		# Append <body> if it already exists
-		new_soup.root.append(xml_body)
-	
-	# Unwrap <body> to move its contents directly into <root>
-	new_soup.body.unwrap()
+		xml_body = old_soup.find()
+
+	# Rename the element <root>. This is equivalent to unwrapping it
+	# into a new <root> element, but doesn't move each of its children
+	# separately, which takes quadratic time with BeautifulSoup.
+	xml_body.extract()
+	xml_body.name = "root"
+	xml_body.prefix = None
+	xml_body.namespace = None
+	xml_body.attrs = {}
+	return xml_body
+
 
+def transform_elements(new_soup: BeautifulSoup, abbr_dictionary):
+	"""Transforms certain elements, attributes and values in new_soup in place."""
 	# get all <anchor/> and remove them
 	anchors = new_soup.find_all("anchor")
+	snapshot = snapshot_elements("transform-anchor", anchors)
 	for anchor in anchors:
 		anchor.unwrap()
+	count_changed_elements("transform-anchor", anchors, snapshot)
 	# get all <pb>, remove @facs and @xml:id, add @type="orig"
 	pbs = new_soup.find_all("pb")
+	snapshot = snapshot_elements("transform-pb", pbs)
 	for pb in pbs:
 		if "facs" in pb.attrs:
 			del pb["facs"]
 		if "xml:id" in pb.attrs:
 			del pb["xml:id"]
 		pb["type"] = "orig"
+	count_changed_elements("transform-pb", pbs, snapshot)
 	# get all <p>, remove @facs and @style
 	ps = new_soup.find_all("p")
+	snapshot = snapshot_elements("transform-p", ps)
 	for p in ps:
 		# Check if <p> contains only an <lg> element
 		if p.lg:
@@ -194,56 +700,76 @@ def transform_xml(old_soup: BeautifulSoup, abbr_dictionary) -> BeautifulSoup:
 				del p["style"]
 			if "rend" in p.attrs:
 				value = p["rend"]
-				if value == "Quote":
-					# Wrap the element in <quote type="block">
+				if value == "Quote" and "teigarage-styles" in rule_stages:
+					# Wrap the element in <quote type="block">, the
+					# block quotes are combined in combine_quote_blocks()
 					p.wrap(new_soup.new_tag("quote", attrs={"type": "block"}))
 					del p["rend"]
-				elif value == "footnote text":
+				elif value == "footnote text" and "teigarage-styles" in rule_stages:
 					p.unwrap()
 				else:
 					del p["rend"]
+	count_changed_elements("transform-p", ps, snapshot)
 	# get all <note>
 	notes = new_soup.find_all("note")
+	set_stage("transform_xml", "transform-note")
+	unwrapped = 0
 	for note in notes:
 		if len(note.contents) == 1 and note.contents[0].name == "p":
 			note.p.unwrap()
-	# get all <l> and remove any @rend="indent" from them
-	ls = new_soup.find_all("l")
-	for l in ls:
-		if "rend" in l.attrs:
-			if l["rend"] == "indent":
-				del l["rend"]
-	# get all <lb/>, remove @facs and @n
-	lbs = new_soup.find_all("lb")
-	for lb in lbs:
-		if "facs" in lb.attrs:
-			del lb["facs"]
-		if "n" in lb.attrs:
-			del lb["n"]
+			unwrapped += 1
+	count_rule_hits("transform-note", unwrapped)
+	if "poetry" in rule_stages:
+		# get all <l> and remove any @rend="indent" from them
+		ls = new_soup.find_all("l")
+		snapshot = snapshot_elements("transform-l", ls)
+		for l in ls:
+			if "rend" in l.attrs:
+				if l["rend"] == "indent":
+					del l["rend"]
+		count_changed_elements("transform-l", ls, snapshot)
+	if "transkribus-lines" in rule_stages:
+		# get all <lb/>, remove @facs and @n
+		lbs = new_soup.find_all("lb")
+		snapshot = snapshot_elements("transform-lb", lbs)
+		for lb in lbs:
+			if "facs" in lb.attrs:
+				del lb["facs"]
+			if "n" in lb.attrs:
+				del lb["n"]
+		count_changed_elements("transform-lb", lbs, snapshot)
 	# get all <table>
 	tables = new_soup.find_all("table")
+	snapshot = snapshot_elements("transform-table", tables)
 	for table in tables:
 		if "rend" in table.attrs:
 			del table["rend"]
-	# get all <cell>
-	cells = new_soup.find_all("cell")
-	for cell in cells:
-		if "style" in cell.attrs:
-			del cell["style"]
-		if "rend" in cell.attrs:
-			if "botBorder" not in cell["rend"] and "rightBorder" not in cell["rend"] and "bold" not in cell["rend"] and "center" not in cell["rend"] and "verticalCenter" not in cell["rend"]:
-				del cell["rend"]
-	# get all <list>
-	lists = new_soup.find_all("list")
-	for list in lists:
-		if "type" in list.attrs:
-			del list["type"]
-		if "rend" in list.attrs:
-			value = list["rend"]
-			if value == "numbered":
-				list["rend"] = "decimal"
+	count_changed_elements("transform-table", tables, snapshot)
+	if "teigarage-styles" in rule_stages:
+		# get all <cell>
+		cells = new_soup.find_all("cell")
+		snapshot = snapshot_elements("transform-cell", cells)
+		for cell in cells:
+			if "style" in cell.attrs:
+				del cell["style"]
+			if "rend" in cell.attrs:
+				if "botBorder" not in cell["rend"] and "rightBorder" not in cell["rend"] and "bold" not in cell["rend"] and "center" not in cell["rend"] and "verticalCenter" not in cell["rend"]:
+					del cell["rend"]
+		count_changed_elements("transform-cell", cells, snapshot)
+		# get all <list>
+		lists = new_soup.find_all("list")
+		snapshot = snapshot_elements("transform-list", lists)
+		for list in lists:
+			if "type" in list.attrs:
+				del list["type"]
+			if "rend" in list.attrs:
+				value = list["rend"]
+				if value == "numbered":
+					list["rend"] = "decimal"
+		count_changed_elements("transform-list", lists, snapshot)
 	# get all <hi>
 	his = new_soup.find_all("hi")
+	snapshot = snapshot_elements("transform-hi", his)
 	for hi in his:
 		if "style" in hi.attrs:
 			del hi["style"]
@@ -280,11 +806,13 @@ def transform_xml(old_soup: BeautifulSoup, abbr_dictionary) -> BeautifulSoup:
 				hi["rend"] = "italics"
 			elif value == "Emphasis":
 				del hi["rend"]
-			elif "Body" in value or "Other" in value or "Footnote" in value or "Table" in value or "Heading" in value:
+			elif "teigarage-styles" in rule_stages and ("Body" in value or "Other" in value or "Footnote" in value or "Table" in value or "Heading" in value):
 				hi.unwrap()
 				continue
+	count_changed_elements("transform-hi", his, snapshot)
 	# get all <seg>
 	segs = new_soup.find_all("seg")
+	snapshot = snapshot_elements("transform-seg", segs)
 	for seg in segs:
 		if "xml:space" in seg.attrs:
 			del seg["xml:space"]
@@ -310,21 +838,27 @@ def transform_xml(old_soup: BeautifulSoup, abbr_dictionary) -> BeautifulSoup:
 		if not seg.attrs:
 			seg.unwrap()
 			continue
+	count_changed_elements("transform-seg", segs, snapshot)
 	# get all <ref>
 	refs = new_soup.find_all("ref")
+	snapshot = snapshot_elements("transform-ref", refs)
 	for ref in refs:
 		if "target" in ref.attrs:
 			ref["type"] = "readingtext"
 			ref["target"] = ""
+	count_changed_elements("transform-ref", refs, snapshot)
 	# get all <ab>
 	abs = new_soup.find_all("ab")
+	snapshot = snapshot_elements("transform-ab", abs)
 	for ab in abs:
 		if "facs" in ab.attrs:
 			del ab["facs"]
 		if "type" in ab.attrs:
 			del ab["type"]
+	count_changed_elements("transform-ab", abs, snapshot)
 	# get all <graphic>
 	graphics = new_soup.find_all("graphic")
+	snapshot = snapshot_elements("transform-graphic", graphics)
 	for graphic in graphics:
 		if "height" in graphic.attrs:
 			del graphic["height"]
@@ -334,24 +868,33 @@ def transform_xml(old_soup: BeautifulSoup, abbr_dictionary) -> BeautifulSoup:
 			del graphic["n"]
 		if "rend" in graphic.attrs:
 			del graphic["rend"]
+	count_changed_elements("transform-graphic", graphics, snapshot)
 	# get all <supplied>
 	supplieds = new_soup.find_all("supplied")
+	snapshot = snapshot_elements("transform-supplied", supplieds)
 	for supplied in supplieds:
 		if "reason" in supplied.attrs:
 			del supplied["reason"]
+	count_changed_elements("transform-supplied", supplieds, snapshot)
 	# get all <comment>
 	comments = new_soup.find_all("comment")
+	snapshot = snapshot_elements("transform-comment", comments)
 	for comment in comments:
 		comment.name = "note"
+	count_changed_elements("transform-comment", comments, snapshot)
 	# get all <tag>
 	tags = new_soup.find_all("tag")
+	snapshot = snapshot_elements("transform-tag", tags)
 	for tag in tags:
 		if tag.string is not None and (str(tag.previous_element) == str("<del><tag>" + tag.string + "</tag></del>") or str(tag.next_element) == str("<del>" + tag.string + "</del>")):
 			tag.unwrap()
 		else:
 			tag.name = "del"
+	count_changed_elements("transform-tag", tags, snapshot)
 	# get all <choice>
 	choices = new_soup.find_all("choice")
+	set_stage("transform_xml", "transform-choice")
+	expanded = 0
 	# it's easy to mark up abbreviations in Transkribus
 	# this gets exported as <choice><abbr>Tit.</abbr><expan/></choice>
 	# if we have a recorded expansion for the abbreviation:
@@ -368,18 +911,44 @@ def transform_xml(old_soup: BeautifulSoup, abbr_dictionary) -> BeautifulSoup:
 				abbr_content = str(abbr)
 				abbr_content = abbr_content.replace("<abbr>", "")
 				abbr_content = abbr_content.replace("</abbr>", "")
-				if abbr_content in abbr_dictionary.keys():
-					expan_content = abbr_dictionary[abbr_content]
+				expan_content = abbr_dictionary.get(abbr_content)
+				if expan_content is not None:
 					# now get the <expan> to update
 					for child in choice.children:
 						# only add content to an empty <expan>
 						if child.name == "expan" and len(child.contents) < 1:
 							child.insert(0, expan_content)
+							expanded += 1
+	count_rule_hits("transform-choice", expanded)
 
-	# Combine sibling <quote type="block"> elements
-	new_soup = combine_quote_blocks(new_soup)
 
-	return new_soup
+# serialize the transformed soup once and free both soups, so that
+# the trees are not kept in memory while the string is tidied
+def serialize_soup(old_soup: BeautifulSoup, new_soup: BeautifulSoup, file_n: int) -> str:
+	xml_string = str(new_soup)
+
+	# Output for debugging
+	if DEBUG:
+		write_to_file(xml_string, f"parsing_temp_{file_n}.xml")
+
+	new_soup.decompose()
+	old_soup.decompose()
+	return xml_string
+
+
+# serialize the <root> element of a document transformed in a batch
+# in the same way as serialize_soup(), and free the element and the
+# original soup
+def serialize_root(old_soup: BeautifulSoup, root, file_n: int) -> str:
+	xml_string = XML_DECLARATION + str(root)
+
+	# Output for debugging
+	if DEBUG:
+		write_to_file(xml_string, f"parsing_temp_{file_n}.xml")
+
+	root.decompose()
+	old_soup.decompose()
+	return xml_string
 
 
 # Get rid of tabs, extra spaces and newlines
@@ -390,123 +959,129 @@ def tidy_up_xml(xml_string: str, abbr_dictionary, file_n: int):
 	# Remove all whitespace characters at the beginning of lines,
  	# including blank lines
 	pattern = re.compile(r"^\s+", re.MULTILINE)
-	xml_string = pattern.sub("", xml_string)
+	xml_string = sub_pattern(pattern, "", xml_string, "strip-line-indent")
 
 	# Remove all carriage returns
-	xml_string = xml_string.replace("\r", "")
+	xml_string = replace_text(xml_string, "\r", "", "remove-carriage-returns")
 
 	# Remove soft hyphen (U+00AD; &shy;) (invisible in VS Code)
-	xml_string = xml_string.replace("­", "")
+	xml_string = replace_text(xml_string, "­", "", "remove-soft-hyphens")
 
 	# Replace no-break spaces with ordinary spaces
-	xml_string = xml_string.replace(" ", " ")
+	xml_string = replace_text(xml_string, " ", " ", "nbsp-to-space")
 
 	# Remove whitespace characters at the start or end of paragraph tags
 	pattern = re.compile(r"<p>\s*")
-	xml_string = pattern.sub("<p>", xml_string)
+	xml_string = sub_pattern(pattern, "<p>", xml_string, "trim-p-start")
 	pattern = re.compile(r"\s*</p>")
-	xml_string = pattern.sub("</p>", xml_string)
-
-	# Ensure all <lb/> start on new lines while processing
-	xml_string = xml_string.replace("<p><lb/>", "<p>\n<lb/>")
-
-	# Replace not signs to hyphens when followed by newlines
-	xml_string = xml_string.replace("¬\n", "-\n")
-	xml_string = xml_string.replace("¬<lb/>\n", "-<lb/>\n")
-
-	# Replace hyphens with dashes when surrounded by combinations
-	# of space, newline and <lb/>
-	xml_string = xml_string.replace(" -\n", " –\n")
-	xml_string = xml_string.replace(" -<lb/>", " –<lb/>")
-	xml_string = xml_string.replace("\n- ", "\n– ")
-	xml_string = xml_string.replace("<lb/>- ", "<lb/>– ")
-	xml_string = xml_string.replace(" - ", " – ")
-
-	# When there are several deleted lines of text,
-	# exports from Transkribus contain one <del> per line,
-	# but it's ok to have a <del> spanning several lines
-	# so let's replace those chopped up <del>:s
-	# the same goes for <add>
-	xml_string = xml_string.replace("</del><lb/>\n<del>", "<lb/>\n")
-	xml_string = xml_string.replace("</del>\n<lb/><del>", "\n<lb/>")
-	xml_string = xml_string.replace("</add><lb/>\n<add>", "<lb/>\n")
-	xml_string = xml_string.replace("</add>\n<lb/><add>", "\n<lb/>")
-
-	# Remove lines that contain just <lb/> if followed by a line starting with <lb/>
-	xml_string = xml_string.replace("\n<lb/>\n<lb/>", "\n<lb/>")
-
-	# Let <hi> continue instead of being broken up into several <hi>:s.
-	# We are assuming that the same @rend value continues on the second line.
-	xml_string = re.sub(r"</hi>(\n<lb[^/]*?/>)<hi[^>]*?>", r"\1", xml_string)
+	xml_string = sub_pattern(pattern, "</p>", xml_string, "trim-p-end")
+
+	if "transkribus-lines" in rule_stages:
+		# Ensure all <lb/> start on new lines while processing
+		xml_string = replace_text(xml_string, "<p><lb/>", "<p>\n<lb/>", "lb-after-p-newline")
+
+		# Replace not signs to hyphens when followed by newlines
+		xml_string = replace_text(xml_string, "¬\n", "-\n", "not-sign-to-hyphen")
+		xml_string = replace_text(xml_string, "¬<lb/>\n", "-<lb/>\n", "not-sign-to-hyphen")
+
+		# Replace hyphens with dashes when surrounded by combinations
+		# of space, newline and <lb/>
+		xml_string = replace_text(xml_string, " -\n", " –\n", "hyphen-to-dash")
+		xml_string = replace_text(xml_string, " -<lb/>", " –<lb/>", "hyphen-to-dash")
+		xml_string = replace_text(xml_string, "\n- ", "\n– ", "hyphen-to-dash")
+		xml_string = replace_text(xml_string, "<lb/>- ", "<lb/>– ", "hyphen-to-dash")
+
+	if "typography" in rule_stages:
+		# Replace hyphens with dashes when surrounded by spaces
+		xml_string = replace_text(xml_string, " - ", " – ", "hyphen-to-dash")
+
+	if "transkribus-lines" in rule_stages:
+		# When there are several deleted lines of text,
+		# exports from Transkribus contain one <del> per line,
+		# but it's ok to have a <del> spanning several lines
+		# so let's replace those chopped up <del>:s
+		# the same goes for <add>
+		xml_string = replace_text(xml_string, "</del><lb/>\n<del>", "<lb/>\n", "merge-del-lines")
+		xml_string = replace_text(xml_string, "</del>\n<lb/><del>", "\n<lb/>", "merge-del-lines")
+		xml_string = replace_text(xml_string, "</add><lb/>\n<add>", "<lb/>\n", "merge-add-lines")
+		xml_string = replace_text(xml_string, "</add>\n<lb/><add>", "\n<lb/>", "merge-add-lines")
+
+		# Remove lines that contain just <lb/> if followed by a line starting with <lb/>
+		xml_string = replace_text(xml_string, "\n<lb/>\n<lb/>", "\n<lb/>", "remove-empty-lb-lines")
+
+		# Let <hi> continue instead of being broken up into several <hi>:s.
+		# We are assuming that the same @rend value continues on the second line.
+		xml_string = sub_pattern(r"</hi>(\n<lb[^/]*?/>)<hi[^>]*?>", r"\1", xml_string, "merge-hi-across-lb")
 
 	# Combine consecutive <hi rend="bold"> and <hi rend="italics"> tags
 	attr_vals = ["bold", "italics"]
 	for val in attr_vals:
-		pattern = re.compile(fr'<hi rend="{val}">((?:(?!</hi>).)*)</hi><hi rend="{val}">((?:(?!</hi>).)*)</hi>')
-		# While loop to repeatedly apply the replacement
-		while pattern.search(xml_string):
-			# Perform the substitution
-			xml_string = pattern.sub(fr'<hi rend="{val}">\1\2</hi>', xml_string)
+		xml_string = combine_hi_elements(xml_string, val)
 	
 	# Move space character at the end of <hi> content outside closing tag
-	xml_string = xml_string.replace(" </hi>", "</hi> ")
+	xml_string = replace_text(xml_string, " </hi>", "</hi> ", "hi-trailing-space")
 
 	# Output for debugging
 	if DEBUG:
 		write_to_file(xml_string, f"tidy_temp_{file_n}.xml")
 
 	if PRESERVE_LB_TAGS:
-		# Move any <lb/> tags at the end of lines to the start
-		# and add attribute indicating hyphens if necessary
-		xml_string = xml_string.replace("-<lb/>\n", '-\n<lb break="word"/>')
-		xml_string = xml_string.replace("-\n<lb/>", '-\n<lb break="word"/>')
-		xml_string = xml_string.replace("<lb/>\n", '\n<lb break="line"/>')
-		xml_string = xml_string.replace("\n<lb/>", '\n<lb break="line"/>')
+		if "transkribus-lines" in rule_stages:
+			# Move any <lb/> tags at the end of lines to the start
+			# and add attribute indicating hyphens if necessary
+			xml_string = replace_text(xml_string, "-<lb/>\n", '-\n<lb break="word"/>', "lb-break-word")
+			xml_string = replace_text(xml_string, "-\n<lb/>", '-\n<lb break="word"/>', "lb-break-word")
+			xml_string = replace_text(xml_string, "<lb/>\n", '\n<lb break="line"/>', "lb-break-line")
+			xml_string = replace_text(xml_string, "\n<lb/>", '\n<lb break="line"/>', "lb-break-line")
 	else:
-		# Remove hyphens followed by closing and opening <p> on new lines
-		xml_string = xml_string.replace("-\n</p>\n<p>", "")
-		# Remove hyphens followed by newlines and <lb/>
-		xml_string = xml_string.replace("-\n<lb/>", "")
-		xml_string = xml_string.replace("-\n", "")
-		# Replace newline followed by <lb/> with space
-		xml_string = xml_string.replace("\n<lb/>", " ")
+		if "transkribus-lines" in rule_stages:
+			# Remove hyphens followed by closing and opening <p> on new lines
+			xml_string = replace_text(xml_string, "-\n</p>\n<p>", "", "join-hyphenated-paragraphs")
+			# Remove hyphens followed by newlines and <lb/>
+			xml_string = replace_text(xml_string, "-\n<lb/>", "", "join-hyphenated-lines")
+			xml_string = replace_text(xml_string, "-\n", "", "join-hyphenated-lines")
+			# Replace newline followed by <lb/> with space
+			xml_string = replace_text(xml_string, "\n<lb/>", " ", "lb-to-space")
 		# Replace any remaining newlines with spaces within <p>
-		xml_string = re.sub(r"<p>.*?</p>", newlines_to_spaces, xml_string, flags=re.DOTALL)
+		xml_string = sub_elements(xml_string, "<p>", "</p>", newlines_to_spaces, "p-newlines-to-spaces")
 		# Remove multiple consecutive whitespace characters within <p>
-		xml_string = re.sub(r"<p>.*?</p>", remove_extra_spaces, xml_string, flags=re.DOTALL)
+		xml_string = sub_elements(xml_string, "<p>", "</p>", remove_extra_spaces, "p-collapse-whitespace")
 
 	# Remove all newline characters
-	xml_string = xml_string.replace("\n", "")
+	xml_string = replace_text(xml_string, "\n", "", "remove-newlines")
 
 	# Replace <pb type="orig"/></p> with </p><pb type="orig"/>
-	xml_string = xml_string.replace('<pb type="orig"/></p>', '</p><pb type="orig"/>')
+	xml_string = replace_text(xml_string, '<pb type="orig"/></p>', '</p><pb type="orig"/>', "pb-after-p")
 
-	# Remove <lb> tags before </p> and before the first <p>
-	xml_string = xml_string.replace("<lb/></p>", "</p>")
-	xml_string = xml_string.replace('<lb break="line"/></p>', "</p>")
-	xml_string = xml_string.replace('<p><lb break="line"/>', "<p>", 1)
+	if "transkribus-lines" in rule_stages:
+		# Remove <lb> tags before </p> and before the first <p>
+		xml_string = replace_text(xml_string, "<lb/></p>", "</p>", "remove-lb-at-p-edges")
+		xml_string = replace_text(xml_string, '<lb break="line"/></p>', "</p>", "remove-lb-at-p-edges")
+		xml_string = replace_text(xml_string, '<p><lb break="line"/>', "<p>", "remove-lb-at-p-edges", 1)
 
 	# Insert newline characters before block-level tags
 	xml_string = insert_newlines_before_block_tags(xml_string)
 
 	# Put <pb/> tags on separate lines
 	pattern = r"(<pb [^>]*?/>)"
-	xml_string = re.sub(pattern, r"\n\1\n", xml_string)
+	xml_string = sub_pattern(pattern, r"\n\1\n", xml_string, "pb-own-line")
 
-	# Insert newlines before <lb/>
-	pattern = r"(<lb[^/]*?/>)"
-	xml_string = re.sub(pattern, r"\n\1", xml_string)
+	if "transkribus-lines" in rule_stages:
+		# Insert newlines before <lb/>
+		pattern = r"(<lb[^/]*?/>)"
+		xml_string = sub_pattern(pattern, r"\n\1", xml_string, "lb-own-line")
 
-	# Remove closing and opening paragraph tags if there is an <lb>
- 	# tag indicating hyphenated word in the line break
-	xml_string = xml_string.replace('\n<lb break="word"/>\n</p>\n<p>', '\n<lb break="word"/>')
+		# Remove closing and opening paragraph tags if there is an <lb>
+		# tag indicating hyphenated word in the line break
+		xml_string = replace_text(xml_string, '\n<lb break="word"/>\n</p>\n<p>', '\n<lb break="word"/>', "join-p-at-word-break")
 
-	# Add space before ... if preceeded by a word character
-	# remove space between full stops and standardize two full stops to three
-	pattern = re.compile(r"(\w) *\. *\.( *\.)?")
-	xml_string = pattern.sub(r"\1 ...", xml_string)
+	if "typography" in rule_stages:
+		# Add space before ... if preceeded by a word character
+		# remove space between full stops and standardize two full stops to three
+		pattern = re.compile(r"(\w) *+\. *+\.(?: *+\.)?")
+		xml_string = sub_pattern(pattern, r"\1 ...", xml_string, "ellipsis")
 
-	if NORMALIZE_LARGE_NUMBERS:
+	if NORMALIZE_LARGE_NUMBERS and "number-normalization" in rule_stages:
 		# For numbers over 999 that have normal space or comma as separator:
 		# replace those separators with the normalized separator.
 		xml_string = normalize_and_format_numbers(
@@ -527,85 +1102,88 @@ def tidy_up_xml(xml_string: str, abbr_dictionary, file_n: int):
 			EXCLUDE_NUMBERS_NORM_MAX
 		)
 
-	# The asterisk stands for a footnote
-	pattern = re.compile(r" *\*\) *")
-	xml_string = pattern.sub("<note xml:id=\"ftn\" n=\"*)\" place=\"foot\"></note>", xml_string)
-
-	# Replace certain characters
-	pattern = re.compile(r"&quot;")
-	xml_string = pattern.sub("”", xml_string)
-	pattern = re.compile(r"&apos;")
-	xml_string = pattern.sub("’", xml_string)
-	pattern = re.compile(r"º")
-	xml_string = pattern.sub("<hi rend=\"raised\">o</hi>", xml_string)
-
-	# There should be a non-breaking space before %
-	pattern = re.compile(r"([^  ])%")
-	xml_string = pattern.sub(r"\1&#x00A0;%", xml_string)
-	pattern = re.compile(r" %")
-	xml_string = pattern.sub(r"&#x00A0;%", xml_string)
+	if "footnote-asterisk" in rule_stages:
+		# The asterisk stands for a footnote
+		pattern = re.compile(r" *\*\) *")
+		xml_string = sub_pattern(pattern, "<note xml:id=\"ftn\" n=\"*)\" place=\"foot\"></note>", xml_string, "footnote-asterisk")
+
+	if "typography" in rule_stages:
+		# Replace certain characters
+		pattern = re.compile(r"&quot;")
+		xml_string = sub_pattern(pattern, "”", xml_string, "quot-entity")
+		pattern = re.compile(r"&apos;")
+		xml_string = sub_pattern(pattern, "’", xml_string, "apos-entity")
+		pattern = re.compile(r"º")
+		xml_string = sub_pattern(pattern, "<hi rend=\"raised\">o</hi>", xml_string, "raised-o")
+
+		# There should be a non-breaking space before %
+		pattern = re.compile(r"([^  ])%")
+		xml_string = sub_pattern(pattern, r"\1&#x00A0;%", xml_string, "nbsp-before-percent")
+		pattern = re.compile(r" %")
+		xml_string = sub_pattern(pattern, r"&#x00A0;%", xml_string, "nbsp-before-percent")
 
 	# Content of element note shouldn't start with space
-	pattern = re.compile(r"(<note .+?>) ")
-	xml_string = pattern.sub(r"\1", xml_string)
+	xml_string = remove_note_leading_space(xml_string)
 
-	# Replace any " characters in text nodes with typographic
-	# right double quotation mark ” as " may only occur inside tags
-	# for attribute values. This method first temporarily replaces
-	# all " with ” and then reverts ” back to " inside tags.
-	xml_string = xml_string.replace('"', '”')
-	xml_string = re.sub(r'<[^>]+>', doublequotes_to_straightquotes, xml_string)
+	if "typography" in rule_stages:
+		# Replace any " characters in text nodes with typographic
+		# right double quotation mark ” as " may only occur inside tags
+		# for attribute values. Any ” inside tags is replaced with ".
+		xml_string = sub_pattern(r'<[^>]+>|"', typographic_doublequotes, xml_string, "doublequote-to-typographic")
 
 	# Remove multiple consecutive space characters
 	pattern = re.compile(r" +")
-	xml_string = pattern.sub(" ", xml_string)
-
-	# Standardize certain other characters
-	xml_string = xml_string.replace("„", "”")
-	xml_string = xml_string.replace("‟", "”")
-	xml_string = xml_string.replace("“", "”")
-	xml_string = xml_string.replace("»", "”")
-	xml_string = xml_string.replace("«", "”")
-	xml_string = xml_string.replace("—", "–")
-	xml_string = xml_string.replace("\'", "’")
-	xml_string = xml_string.replace("’’", "”")
-	xml_string = xml_string.replace("´", "’")
-
-	# Indent lines starting with <lb/> within <p>
-	xml_string = re.sub(r"<p>.*?</p>", indent_lb_tags, xml_string, flags=re.DOTALL)
-
-	# Indent lines starting with <l> within <lg>
-	xml_string = re.sub(r"<lg>.*?</lg>", indent_l_tags, xml_string, flags=re.DOTALL)
+	xml_string = sub_pattern(pattern, " ", xml_string, "collapse-spaces")
+
+	if "typography" in rule_stages:
+		# Standardize certain other characters
+		xml_string = replace_text(xml_string, "„", "”", "standardize-characters")
+		xml_string = replace_text(xml_string, "‟", "”", "standardize-characters")
+		xml_string = replace_text(xml_string, "“", "”", "standardize-characters")
+		xml_string = replace_text(xml_string, "»", "”", "standardize-characters")
+		xml_string = replace_text(xml_string, "«", "”", "standardize-characters")
+		xml_string = replace_text(xml_string, "—", "–", "standardize-characters")
+		xml_string = replace_text(xml_string, "\'", "’", "standardize-characters")
+		xml_string = replace_text(xml_string, "’’", "”", "standardize-characters")
+		xml_string = replace_text(xml_string, "´", "’", "standardize-characters")
+
+	if "transkribus-lines" in rule_stages:
+		# Indent lines starting with <lb/> within <p>
+		xml_string = sub_elements(xml_string, "<p>", "</p>", indent_lb_tags, "indent-lb")
+
+	if "poetry" in rule_stages:
+		# Indent lines starting with <l> within <lg>
+		xml_string = sub_elements(xml_string, "<lg>", "</lg>", indent_l_tags, "indent-l")
 
 	# Indent <item> elements
-	xml_string = xml_string.replace("<item>", "\t<item>")
+	xml_string = replace_text(xml_string, "<item>", "\t<item>", "indent-item")
 
-	if PRESERVE_LB_TAGS:
+	if PRESERVE_LB_TAGS and "transkribus-lines" in rule_stages:
 		# Change <lb/> break type to word if previous line ends with hyphen
 		# marked by <pc> tag.
-		xml_string = xml_string.replace('<pc>-</pc>\n\t<lb break="line"/>', '<pc>-</pc>\n\t<lb break="word"/>')
-	else:
+		xml_string = replace_text(xml_string, '<pc>-</pc>\n\t<lb break="line"/>', '<pc>-</pc>\n\t<lb break="word"/>', "pc-hyphen-lb-break-word")
+	elif not PRESERVE_LB_TAGS:
 		# Remove whitespace characters at the start or end of paragraph tags
 		pattern = re.compile(r"<p>\s*")
-		xml_string = pattern.sub("<p>", xml_string)
+		xml_string = sub_pattern(pattern, "<p>", xml_string, "final-trim-p-start")
 		pattern = re.compile(r"\s*</p>")
-		xml_string = pattern.sub("</p>", xml_string)
+		xml_string = sub_pattern(pattern, "</p>", xml_string, "final-trim-p-end")
 		# Remove space character after closing <pc> tag
-		xml_string = xml_string.replace("</pc> ", "</pc>")
+		xml_string = replace_text(xml_string, "</pc> ", "</pc>", "pc-trailing-space")
 
 	# Remove empty <p/>
-	xml_string = xml_string.replace("<p>\n</p>", "<p/>")
-	xml_string = xml_string.replace("<p/>\n", "")
-	xml_string = xml_string.replace("<p/>", "")
-	xml_string = xml_string.replace("<p></p>", "")
+	xml_string = replace_text(xml_string, "<p>\n</p>", "<p/>", "remove-empty-p")
+	xml_string = replace_text(xml_string, "<p/>\n", "", "remove-empty-p")
+	xml_string = replace_text(xml_string, "<p/>", "", "remove-empty-p")
+	xml_string = replace_text(xml_string, "<p></p>", "", "remove-empty-p")
 
 	# Replace multiple consecutive newlines with a single newline
-	xml_string = re.sub(r"\n+", "\n", xml_string)
+	xml_string = sub_pattern(r"\n+", "\n", xml_string, "collapse-newlines")
 
 	# Ensure line break before <p>
-	xml_string = xml_string.replace("</p><p>", "</p>\n<p>")
+	xml_string = replace_text(xml_string, "</p><p>", "</p>\n<p>", "newline-between-p")
 
-	if CHECK_UNTAGGED_ABBREVIATIONS is True:
+	if CHECK_UNTAGGED_ABBREVIATIONS is True and "untagged-abbreviations" in rule_stages:
 		xml_string = replace_untagged_abbreviations(xml_string, abbr_dictionary)
 
 	return xml_string
@@ -619,7 +1197,7 @@ def insert_newlines_before_block_tags(text: str) -> str:
 	]
 
 	for tag in before_tags:
-		text = text.replace(tag, "\n" + tag)
+		text = replace_text(text, tag, "\n" + tag, "block-tag-newlines")
 
 	tags_with_attr = [
 		"div", "p", "lg", "head", "l", "list", "quote"
@@ -630,51 +1208,212 @@ def insert_newlines_before_block_tags(text: str) -> str:
 		# Create the regex pattern dynamically
 		pattern = fr"(<{name} [^>]+?>)"
 		# Perform the replacement
-		text = re.sub(pattern, r"\n\1", text)
+		text = sub_pattern(pattern, r"\n\1", text, "block-tag-newlines")
 
 	return text
 
 
-# Function to remove newlines within a match
-def newlines_to_spaces(match):
-	return match.group(0).replace("\n", " ")
+# Function to remove newlines within an element
+def newlines_to_spaces(text):
+	return text.replace("\n", " ")
 
 
-# Function to replace multiple consecutive whitespace characters within a 
-# match with a single space
-def remove_extra_spaces(match):
+# Function to replace multiple consecutive whitespace characters within an
+# element with a single space
+def remove_extra_spaces(text):
 	# Replace all sequences of whitespace characters with a single space
-	return re.sub(r"\s+", " ", match.group(0))
+	return re.sub(r"\s+", " ", text)
 
 
 def remove_hyphenated_newlines(match):
 	return match.group(0).replace("-<lb/>", "")
 
 
-def indent_lb_tags(match):
-	return re.sub(r"\n(<lb [^>]*?/>)", r"\n\t\1", match.group(0))
+def indent_lb_tags(text):
+	return re.sub(r"\n(<lb [^>]*?/>)", r"\n\t\1", text)
+
+
+def indent_l_tags(text):
+	return text.replace("\n<l>", "\n\t<l>")
+
+
+# Function to remove the tags between consecutive <hi> elements
+# with the same @rend value in a match
+# Combine each run of consecutive <hi rend="{val}"> elements on the
+# same line into one element by removing the tags between them. An
+# element ends at the first </hi> after its start tag, which must come
+# before the end of the line. The positions of all </hi> tags and line
+# ends are looked up once, so unclosed elements don't cause a scan to
+# the end of the line for each start tag.
+def combine_hi_elements(text: str, val: str) -> str:
+	rule = f"combine-hi-{val}"
+	set_stage("tidy_up_xml", rule)
+	start_tag = f'<hi rend="{val}">'
+	boundary = "</hi>" + start_tag
+	if boundary not in text:
+		if rule_telemetry is not None:
+			rule_telemetry.record(rule, 0)
+		return text
+	end_tags = [match.start() for match in re.finditer("</hi>", text)]
+	line_ends = [match.start() for match in re.finditer("\n", text)]
+
+	def element_end(start):
+		content_start = start + len(start_tag)
+		n = bisect.bisect_left(end_tags, content_start)
+		if n == len(end_tags):
+			return -1
+		m = bisect.bisect_left(line_ends, content_start)
+		if m < len(line_ends) and line_ends[m] < end_tags[n]:
+			return -1
+		return end_tags[n] + len("</hi>")
+
+	parts = []
+	matches = 0
+	chars_changed = 0
+	pos = 0
+	search_pos = 0
+	while True:
+		start = text.find(start_tag, search_pos)
+		if start == -1:
+			break
+		run_end = element_end(start)
+		elements = 0
+		while run_end != -1:
+			elements += 1
+			if not text.startswith(start_tag, run_end):
+				break
+			next_end = element_end(run_end)
+			if next_end == -1:
+				break
+			run_end = next_end
+		if elements < 2:
+			search_pos = start + 1
+			continue
+		run = text[start:run_end]
+		new_run = run.replace(boundary, "")
+		parts.append(text[pos:start])
+		parts.append(new_run)
+		matches += 1
+		chars_changed += len(run) - len(new_run)
+		pos = search_pos = run_end
+	if matches == 0:
+		new_text = text
+	else:
+		parts.append(text[pos:])
+		new_text = "".join(parts)
+	if rule_telemetry is not None:
+		rule_telemetry.record(rule, matches, chars_changed, len(new_text) - len(text))
+	return new_text
+
+
+# Apply function to the text of each element from start_tag to the
+# first following end_tag, like re.sub(start_tag + ".*?" + end_tag)
+# with the DOTALL flag. Uses plain string searches, so unclosed
+# elements don't cause a scan to the end of the text for each start tag.
+def sub_elements(text: str, start_tag: str, end_tag: str, function, rule: str) -> str:
+	set_stage("tidy_up_xml", rule)
+	parts = []
+	matches = 0
+	chars_changed = 0
+	pos = 0
+	search_pos = 0
+	while True:
+		start = text.find(start_tag, search_pos)
+		if start == -1:
+			break
+		end = text.find(end_tag, start + len(start_tag))
+		if end == -1:
+			break
+		end += len(end_tag)
+		element = text[start:end]
+		new_element = function(element)
+		if new_element != element:
+			parts.append(text[pos:start])
+			parts.append(new_element)
+			matches += 1
+			chars_changed += changed_length(element, new_element)
+			pos = end
+		search_pos = end
+	if matches == 0:
+		new_text = text
+	else:
+		parts.append(text[pos:])
+		new_text = "".join(parts)
+	if rule_telemetry is not None:
+		rule_telemetry.record(rule, matches, chars_changed, len(new_text) - len(text))
+	return new_text
+
+
+# Remove the space after the start tag of <note> elements, like
+# re.sub(r"(<note .+?>) ", r"\1") but without rescanning the rest
+# of the line for each <note> that isn't followed by "> " on the
+# same line.
+def remove_note_leading_space(text: str) -> str:
+	set_stage("tidy_up_xml", "note-leading-space")
+	parts = []
+	matches = 0
+	pos = 0
+	search_pos = 0
+	while True:
+		start = text.find("<note ", search_pos)
+		if start == -1:
+			break
+		line_end = text.find("\n", start)
+		if line_end == -1:
+			line_end = len(text)
+		tag_end = text.find("> ", start + 7, line_end + 1)
+		if tag_end == -1:
+			# No later <note> on this line can match either
+			search_pos = line_end
+			continue
+		parts.append(text[pos:tag_end + 1])
+		matches += 1
+		pos = search_pos = tag_end + 2
+	if matches == 0:
+		new_text = text
+	else:
+		parts.append(text[pos:])
+		new_text = "".join(parts)
+	if rule_telemetry is not None:
+		rule_telemetry.record("note-leading-space", matches, matches, len(new_text) - len(text))
+	return new_text
 
 
-def indent_l_tags(match):
-	return match.group(0).replace("\n<l>", "\n\t<l>")
+def typographic_doublequotes(match):
+	if match.group(0) == '"':
+		return '”'
+	return match.group(0).replace('”', '"')
 
 
-def doublequotes_to_straightquotes(match):
-	return match.group(0).replace('”', '"')
+# certain words should only be given expans if they have
+# been encoded as abbrs, otherwise they probably aren't
+# abbrs but just ordinary words that can't be expanded.
+# These words are not expanded when untagged unless a list
+# of exclusions is given in ABBR_EXCLUSIONS_FILEPATH
+DO_NOT_EXPAND = ["a.", "adress.", "af", "af.", "afsigt", "allmän", "angelägen", "angelägen.", "art", "B", "B.", "beslut", "beslut.", "bl.", "borg", "borg.", "c.", "d", "D", "D.", "dat", "del", "del.", "des", "E", "E.", "erkände", "f.", "f:", "F.", "fl.", "fr", "Fr", "Fr.", "följ", "Följ", "för", "för.", "föredrag", "förhand", "förhand.", "förord", "först", "först.", "G.", "ge", "ge.", "gen", "gifter", "gång.", "H", "H.", "hand.", "just", "Just", "k.", "K", "K.", "K. F", "K. F.", "kg", "kung", "Kung", "l", "L", "L.", "lämpligt", "lämpligt.", "m", "m.", "M", "M.", "Maj.", "med", "med.", "min", "min.", "mån", "n", "n.", "N", "N.", "nu", "nu.", "ord", "ord.", "period", "period.", "propos", "public", "R", "R.", "redo", "regn", "regn.", "rest", "rest.", "rörde", "s", "s.", "S", "S.", "sammans.", "säg", "Säg", "sigill", "St", "St.", "S<hi rend=\"raised\">t", "S<hi rend=\"raised\">t</hi> Petersburg", "system.", "t.", "tills", "Tills", "tur", "upp", "upp.", "utfärd", "utfärd.", "v.", "verk.", "väg.", "W", "W.", "öfver."]
+
+# the context an untagged abbr must have: the characters that
+# can precede it and the characters or tags that must follow it
+ABBREVIATION_START_PATTERN = re.compile(r"[\s»”(]")
+ABBREVIATION_END_PATTERN = re.compile(r"(?=\s|\.|,|\?|!|»|”|:|;|\)|<lb/>|</p>)")
+
+# the characters that end the head of an abbr: the characters that
+# can follow an abbr and the start of any tag
+ABBREVIATION_HEAD_END_PATTERN = re.compile(r"[\s.,?!»”:;)<]")
 
 
 # if abbreviations haven't been encoded but we still want to
 # add likely expansions to them: use this option
 def replace_untagged_abbreviations(xml_string, abbr_dictionary):
-	# certain words should only be given expans if they have
-	# been encoded as abbrs, otherwise they probably aren't
-	# abbrs but just ordinary words that can't be expanded
-	# keep these words in this list
-	do_not_expand = ["a.", "adress.", "af", "af.", "afsigt", "allmän", "angelägen", "angelägen.", "art", "B", "B.", "beslut", "beslut.", "bl.", "borg", "borg.", "c.", "d", "D", "D.", "dat", "del", "del.", "des", "E", "E.", "erkände", "f.", "f:", "F.", "fl.", "fr", "Fr", "Fr.", "följ", "Följ", "för", "för.", "föredrag", "förhand", "förhand.", "förord", "först", "först.", "G.", "ge", "ge.", "gen", "gifter", "gång.", "H", "H.", "hand.", "just", "Just", "k.", "K", "K.", "K. F", "K. F.", "kg", "kung", "Kung", "l", "L", "L.", "lämpligt", "lämpligt.", "m", "m.", "M", "M.", "Maj.", "med", "med.", "min", "min.", "mån", "n", "n.", "N", "N.", "nu", "nu.", "ord", "ord.", "period", "period.", "propos", "public", "R", "R.", "redo", "regn", "regn.", "rest", "rest.", "rörde", "s", "s.", "S", "S.", "sammans.", "säg", "Säg", "sigill", "St", "St.", "S<hi rend=\"raised\">t", "S<hi rend=\"raised\">t</hi> Petersburg", "system.", "t.", "tills", "Tills", "tur", "upp", "upp.", "utfärd", "utfärd.", "v.", "verk.", "väg.", "W", "W.", "öfver."]
-	# these are all the recorded abbrs that we hav en expan for
-	abbr_list = abbr_dictionary.keys()
-	for abbreviation in abbr_list:
-		if abbreviation in do_not_expand:
+	# instead of searching the text for every recorded abbr, look
+	# up the parts of the text that could be abbrs in the index,
+	# and search only for the abbrs found, in order of priority
+	candidates = abbr_dictionary.find_in_text(xml_string)
+	queue = [(position, abbreviation) for abbreviation, (position, _) in candidates.items()]
+	heapq.heapify(queue)
+	while len(queue) > 0:
+		position, abbreviation = heapq.heappop(queue)
+		if abbreviation in abbr_dictionary.exclusions:
 			continue
 		# prevent abbrs containing a dot from being treated as regex
 		# otherwise e.g. abbr "Fr." matches "Fri" in the text
@@ -688,12 +1427,48 @@ def replace_untagged_abbreviations(xml_string, abbr_dictionary):
 		if result is not None:
 			# get the expan for this abbr and substitute this
 			# part of the text
-			expansion = abbr_dictionary[abbreviation]
-			xml_string = pattern.sub(r"\1" + "<choice><abbr>" + abbreviation + "</abbr><expan>" + expansion + "</expan></choice>" r"\2", xml_string)
+			expansion = candidates[abbreviation][1]
+			xml_string = sub_pattern(pattern, r"\1" + "<choice><abbr>" + abbreviation + "</abbr><expan>" + expansion + "</expan></choice>" r"\2", xml_string, "untagged-abbreviations")
+			# the inserted abbr and expan can contain abbrs
+			# which have not yet been searched for
+			inserted = abbr_dictionary.find_in_text(" " + abbreviation + " " + expansion + " ")
+			for new_abbreviation, (new_position, new_expansion) in inserted.items():
+				if new_position > position and new_abbreviation not in candidates:
+					candidates[new_abbreviation] = (new_position, new_expansion)
+					heapq.heappush(queue, (new_position, new_abbreviation))
 
 	return xml_string
 
 
+# get the head of an abbr, i.e. the part before the first character
+# that could follow an untagged abbr. An abbr found in the text has
+# the same head as the text at the position it starts from.
+def abbreviation_head(text: str, start: int = 0) -> str:
+	match = ABBREVIATION_HEAD_END_PATTERN.search(text, start)
+	return text[start:] if match is None else text[start:match.start()]
+
+
+# get the positions in the text where an untagged abbr could start,
+# grouped by the head of the text at each position
+def find_abbreviation_starts(text: str) -> dict:
+	starts_by_head = {}
+	starts = [0] + [match.end() for match in ABBREVIATION_START_PATTERN.finditer(text)]
+	for start in starts:
+		starts_by_head.setdefault(abbreviation_head(text, start), []).append(start)
+	return starts_by_head
+
+
+# yield the parts of the text which have the context of an untagged
+# abbr, start from one of starts and are at most max_length characters
+# long
+def find_abbreviation_candidates(text: str, ends: list, starts: list, max_length: int):
+	for start in starts:
+		n = bisect.bisect_left(ends, start)
+		while n < len(ends) and ends[n] - start <= max_length:
+			yield text[start:ends[n]]
+			n += 1
+
+
 def add_thousand_separators(text, separator, reg_encode, exclude_min, exclude_max):
 	# Function to format the number with narrow non-breaking space as a separator
 	def format_number(match):
@@ -719,7 +1494,7 @@ def add_thousand_separators(text, separator, reg_encode, exclude_min, exclude_ma
 			return number
 
 	# Replace all occurrences of numbers with four or more digits in the text
-	return re.sub(r'\b\d{4,}\b', format_number, text)
+	return sub_pattern(r'\b\d{4,}\b', format_number, text, "add-thousand-separators")
 
 
 def normalize_and_format_numbers(text, new_separator, reg_encode):
@@ -740,7 +1515,7 @@ def normalize_and_format_numbers(text, new_separator, reg_encode):
 	# \d{1,3} matches up to three digits (covering cases like 1,000 to 999,999), and
  	# (?:[,\s]\d{3})+ matches groups of three digits prefixed by either a comma or a space
 	# one or more times.
-	return re.sub(r'\b\d{1,3}(?:[,\s]\d{3})+\b', reformat_with_separator, text)
+	return sub_pattern(r'\b\d{1,3}(?:[,\s]\d{3})+\b', reformat_with_separator, text, "normalize-number-separators")
 
 
 def combine_quote_blocks(soup):
@@ -783,18 +1558,410 @@ def combine_quote_blocks(soup):
 	return soup
 
 
-# save the new xml file in another folder
+# record the stage (and the rule) the current file is in, so that it
+# can be reported if the file exceeds a limit in a worker process
+def set_stage(stage: str, rule: str = ""):
+	if current_stage is not None:
+		if rule:
+			stage = f"{stage}, rule {rule}"
+		current_stage.value = stage.encode("utf-8")[:len(current_stage) - 1]
+
+
+# replace all (or count) occurrences of old with new in text,
+# recording the replacement under rule if telemetry is enabled
+def replace_text(text: str, old: str, new: str, rule: str, count: int = -1) -> str:
+	set_stage("tidy_up_xml", rule)
+	if rule_telemetry is None:
+		return text.replace(old, new, count)
+	matches = text.count(old)
+	if count >= 0:
+		matches = min(matches, count)
+	if matches == 0 or old == new:
+		rule_telemetry.record(rule, 0)
+		return text
+	rule_telemetry.record(rule, matches, matches * changed_length(old, new), matches * (len(new) - len(old)))
+	return text.replace(old, new, count)
+
+
+# regex substitution of pattern (a string or a compiled pattern)
+# in text, recording the substitution under rule if telemetry is
+# enabled. Only matches whose replacement differs from the matched
+# text are counted.
+def sub_pattern(pattern, repl, text: str, rule: str, flags: int = 0) -> str:
+	set_stage("tidy_up_xml", rule)
+	if rule_telemetry is None:
+		return re.sub(pattern, repl, text, flags=flags)
+	counts = [0, 0]
+
+	def replace(match):
+		old = match.group(0)
+		new = repl(match) if callable(repl) else match.expand(repl)
+		if new != old:
+			counts[0] += 1
+			counts[1] += changed_length(old, new)
+		return new
+
+	new_text = re.sub(pattern, replace, text, flags=flags)
+	rule_telemetry.record(rule, counts[0], counts[1], len(new_text) - len(text))
+	return new_text
+
+
+# the number of characters removed and inserted when old is replaced
+# with new, not counting the start and end they have in common
+def changed_length(old: str, new: str) -> int:
+	prefix = len(os.path.commonprefix([old, new]))
+	max_suffix = min(len(old), len(new)) - prefix
+	suffix = 0
+	while suffix < max_suffix and old[-1 - suffix] == new[-1 - suffix]:
+		suffix += 1
+	return len(old) + len(new) - 2 * (prefix + suffix)
+
+
+# record the number of elements a rule in transform_xml has
+# changed if telemetry is enabled
+def count_rule_hits(rule: str, hits: int):
+	if rule_telemetry is not None:
+		rule_telemetry.record(rule, hits)
+
+
+# get the names and attributes of the elements a rule in
+# transform_xml is applied to if telemetry is enabled, so that
+# the elements the rule changes can be counted afterwards
+def snapshot_elements(rule: str, elements: list):
+	set_stage("transform_xml", rule)
+	if rule_telemetry is None:
+		return None
+	return [(element.name, dict(element.attrs), element.parent is None) for element in elements]
+
+
+# record the number of elements which a rule in transform_xml has
+# renamed, changed the attributes of, or removed from the tree
+def count_changed_elements(rule: str, elements: list, snapshot):
+	if snapshot is None:
+		return
+	changed = 0
+	for element, state in zip(elements, snapshot):
+		if (element.name, element.attrs, element.parent is None) != state:
+			changed += 1
+	rule_telemetry.record(rule, changed)
+
+
+class AbbreviationIndex:
+	"""
+	Looks up abbreviations and their expansions in the SQLite index of
+	the abbreviation dictionaries, so that the dictionaries don't have
+	to be held in memory. Each process opens its own read-only
+	connection to the index on first use.
+	"""
+
+	def __init__(self, index_filepath, exclusions: frozenset):
+		self.index_filepath = index_filepath
+		self.exclusions = exclusions
+		self.connection = None
+		self.connection_pid = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["connection"] = None
+		state["connection_pid"] = None
+		return state
+
+	def query(self, sql: str, parameters=()) -> list:
+		if self.connection is None or self.connection_pid != os.getpid():
+			uri = pathlib.Path(self.index_filepath).resolve().as_uri() + "?mode=ro"
+			self.connection = sqlite3.connect(uri, uri=True)
+			self.connection_pid = os.getpid()
+		return self.connection.execute(sql, parameters).fetchall()
+
+	def query_in_chunks(self, sql: str, values):
+		"""Yields the rows of sql for values in chunks, sql has {placeholders} for the values of a chunk."""
+		chunk = set()
+		for value in values:
+			chunk.add(value)
+			if len(chunk) == ABBR_LOOKUP_CHUNK_SIZE:
+				yield from self.query(sql.format(placeholders=", ".join(["?"] * len(chunk))), list(chunk))
+				chunk = set()
+		if len(chunk) > 0:
+			yield from self.query(sql.format(placeholders=", ".join(["?"] * len(chunk))), list(chunk))
+
+	def get(self, abbreviation: str):
+		if self.index_filepath is None:
+			return None
+		rows = self.query("SELECT expansion FROM abbreviations WHERE abbreviation = ?", (abbreviation,))
+		return rows[0][0] if len(rows) > 0 else None
+
+	def find_in_text(self, text: str) -> dict:
+		"""Returns the abbreviations in the index which could be untagged abbreviations in text, with their positions and expansions."""
+		found = {}
+		if self.index_filepath is None:
+			return found
+		starts_by_head = find_abbreviation_starts(text)
+		head_rows = self.query_in_chunks("SELECT head, max_length FROM heads WHERE head IN ({placeholders})", starts_by_head)
+		ends = [match.start() for match in ABBREVIATION_END_PATTERN.finditer(text)]
+		candidates = (
+			candidate
+			for head, max_length in head_rows
+			for candidate in find_abbreviation_candidates(text, ends, starts_by_head[head], max_length)
+		)
+		rows = self.query_in_chunks("SELECT abbreviation, position, expansion FROM abbreviations WHERE abbreviation IN ({placeholders})", candidates)
+		for abbreviation, position, expansion in rows:
+			found[abbreviation] = (position, expansion)
+		return found
+
+
+class RuleTelemetry:
+	"""
+	Collects, per file and in aggregate, the number of matches of each
+	named rule which changed the xml, the number of characters removed
+	and inserted by the rule, and the resulting change in length (in
+	characters) of the xml.
+	"""
+
+	def __init__(self):
+		self.file_stats = {}
+		self.current_stats = self.file_stats.setdefault("", {})
+
+	def start_file(self, filename: str):
+		self.current_stats = self.file_stats.setdefault(filename, {})
+
+	def record(self, rule: str, matches: int, chars_changed: int = 0, size_delta: int = 0):
+		stats = self.current_stats.get(rule)
+		if stats is None:
+			self.current_stats[rule] = [matches, chars_changed, size_delta]
+		else:
+			stats[0] += matches
+			stats[1] += chars_changed
+			stats[2] += size_delta
+
+	def totals(self) -> dict:
+		totals = {}
+		for stats in self.file_stats.values():
+			for rule, (matches, chars_changed, size_delta) in stats.items():
+				rule_totals = totals.setdefault(rule, [0, 0, 0])
+				rule_totals[0] += matches
+				rule_totals[1] += chars_changed
+				rule_totals[2] += size_delta
+		return totals
+
+	def export(self, filepath: str):
+		"""Saves the counts as CSV if filepath ends with .csv, otherwise as JSON."""
+		stats_by_file = {"TOTAL": self.totals()}
+		stats_by_file.update(
+			(filename, stats) for filename, stats in self.file_stats.items() if filename
+		)
+
+		if filepath.lower().endswith(".csv"):
+			with open(filepath, "w", encoding="utf-8", newline="") as output_file:
+				writer = csv.writer(output_file)
+				writer.writerow(["file", "rule", "matches", "chars_changed", "size_delta"])
+				for filename, stats in stats_by_file.items():
+					for rule, (matches, chars_changed, size_delta) in stats.items():
+						writer.writerow([filename, rule, matches, chars_changed, size_delta])
+		else:
+			json_content = {
+				filename: {
+					rule: {"matches": matches, "chars_changed": chars_changed, "size_delta": size_delta}
+					for rule, (matches, chars_changed, size_delta) in stats.items()
+				}
+				for filename, stats in stats_by_file.items()
+			}
+			with open(filepath, "w", encoding="utf-8") as output_file:
+				json.dump(json_content, output_file, ensure_ascii=False, indent=2)
+
+
+class GuardedWorker:
+	"""
+	Processes files one at a time in a worker process with a wall-clock
+	time limit and a memory limit per file. The worker process is
+	restarted after a file has exceeded a limit.
+	"""
+
+	def __init__(self, abbr_dictionary, timeout: int, memory_limit_mb: int):
+		self.abbr_dictionary = abbr_dictionary
+		self.timeout = timeout if timeout > 0 else None
+		self.memory_limit_mb = memory_limit_mb
+		self.stage = multiprocessing.RawArray("c", 128)
+		self.worker_process = None
+		self.connection = None
+
+	def start(self):
+		self.connection, worker_connection = multiprocessing.Pipe()
+		self.worker_process = multiprocessing.Process(
+			target=guarded_worker,
+			args=(
+				worker_connection,
+				self.stage,
+				self.abbr_dictionary,
+				rule_stages,
+				self.memory_limit_mb,
+				rule_telemetry is not None
+			),
+			daemon=True
+		)
+		self.worker_process.start()
+		worker_connection.close()
+		# Wait until the worker is ready, so that the start-up time
+		# is not counted towards the time limit of the first file
+		self.connection.recv()
+
+	def stop(self):
+		if self.worker_process is not None:
+			try:
+				self.connection.send(None)
+				self.worker_process.join(5)
+			except OSError:
+				pass
+			self.kill()
+
+	def kill(self):
+		if self.worker_process is not None:
+			if self.worker_process.is_alive():
+				self.worker_process.kill()
+			self.worker_process.join()
+			self.connection.close()
+			self.worker_process = None
+			# a worker killed while writing a file leaves its
+			# temporary file in the output folder
+			remove_temp_files(OUTPUT_FOLDER)
+
+	def run_file(self, file, file_n: int) -> tuple:
+		"""Processes file in the worker process and returns the same tuple as run_file(), with the status "quarantined" if the file exceeded a limit."""
+		if self.worker_process is None:
+			try:
+				self.start()
+			except EOFError:
+				self.kill()
+				return ("failed", "the worker process could not be started", None, None, None)
+		self.stage.value = b"read_xml"
+		self.connection.send((file, file_n))
+
+		if not self.connection.poll(self.timeout):
+			stage = self.stage.value.decode("utf-8", errors="replace")
+			self.kill()
+			return ("quarantined", f"time limit of {self.timeout} seconds exceeded", stage, None, None)
+
+		try:
+			result = self.connection.recv()
+		except EOFError:
+			stage = self.stage.value.decode("utf-8", errors="replace")
+			self.worker_process.join()
+			exitcode = self.worker_process.exitcode
+			self.kill()
+			if exitcode == MEMORY_LIMIT_EXIT_CODE:
+				return ("quarantined", f"memory limit of {self.memory_limit_mb} MB exceeded", stage, None, None)
+			return ("quarantined", f"worker process exited with code {exitcode}", stage, None, None)
+
+		return result
+
+
+# process files received through connection one at a time until None is
+# received, target of the worker process started by GuardedWorker
+def guarded_worker(connection, stage, abbr_dictionary, stages, memory_limit_mb: int, collect_telemetry: bool):
+	global current_stage, rule_stages, rule_telemetry
+	current_stage = stage
+	rule_stages = stages
+	if collect_telemetry:
+		rule_telemetry = RuleTelemetry()
+
+	if memory_limit_mb > 0 and resource is not None:
+		memory_limit = memory_limit_mb * 1024 * 1024
+		resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+	if REPORT_PEAK_MEMORY:
+		tracemalloc.start()
+
+	try:
+		connection.send("ready")
+		while True:
+			task = connection.recv()
+			if task is None:
+				break
+			file, file_n = task
+			try:
+				status, detail, _, peak_mb, _ = run_file(file, abbr_dictionary, file_n)
+			except MemoryError:
+				raise
+			except Exception as error:
+				connection.send(("failed", f"{type(error).__name__}: {error}", None, None, None))
+				continue
+
+			file_stats = None
+			if rule_telemetry is not None:
+				file_stats = rule_telemetry.file_stats.pop(file, None)
+			connection.send((status, detail, None, peak_mb, file_stats))
+	except MemoryError:
+		# Exit immediately, since handling the error could need more
+		# memory. The stage is read from shared memory by the parent.
+		os._exit(MEMORY_LIMIT_EXIT_CODE)
+
+
+# copy a file which exceeded a limit to the quarantine folder together
+# with a text file describing the limit and the stage it was in
+def quarantine_file(filename, reason, stage):
+	os.makedirs(QUARANTINE_FOLDER, exist_ok=True)
+	shutil.copyfile(os.path.join(SOURCE_FOLDER, filename), os.path.join(QUARANTINE_FOLDER, filename))
+	with open(os.path.join(QUARANTINE_FOLDER, filename + ".txt"), "w", encoding="utf-8") as diagnostic_file:
+		diagnostic_file.write(f"File: {SOURCE_FOLDER}/{filename}\n")
+		diagnostic_file.write(f"Reason: {reason}\n")
+		diagnostic_file.write(f"Stage: {stage}\n")
+
+
+# remove temporary files left in folder by write_to_file()
+def remove_temp_files(folder):
+	for filename in os.listdir(folder):
+		if filename.startswith(".") and filename.endswith(".tmp"):
+			try:
+				os.remove(os.path.join(folder, filename))
+			except OSError:
+				pass
+
+
+# save the new xml file in another folder, skipping the write if
+# the file already has identical content. The output folder is
+# created once in main(). Returns "written" or "unchanged".
 def write_to_file(tidy_xml_string, filename):
-	if not os.path.exists(OUTPUT_FOLDER):
-		os.makedirs(OUTPUT_FOLDER)
+	filepath = os.path.join(OUTPUT_FOLDER, filename)
 
-	if DEBUG:
-		newline_char = ""
-	else:
-		newline_char = None
-	output_file = open(os.path.join(OUTPUT_FOLDER, filename), "w", encoding="utf-8", newline=newline_char)
-	output_file.write(tidy_xml_string)
-	output_file.close()
+	# Translate newlines the same way text mode would, so the
+	# bytes compared are the bytes that end up on disk
+	if not DEBUG and os.linesep != "\n":
+		tidy_xml_string = tidy_xml_string.replace("\n", os.linesep)
+	content = tidy_xml_string.encode("utf-8")
+
+	if file_has_content(filepath, content):
+		return "unchanged"
+
+	# Write to a temporary file in the output folder and rename it
+	# over the target, so a half-written file is never visible
+	fd, temp_path = tempfile.mkstemp(dir=OUTPUT_FOLDER, prefix=".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as output_file:
+			output_file.write(content)
+		# mkstemp creates the file as private, give it the
+		# permissions an ordinary open() would have
+		current_umask = os.umask(0)
+		os.umask(current_umask)
+		os.chmod(temp_path, 0o666 & ~current_umask)
+		os.replace(temp_path, filepath)
+	except BaseException:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		raise
+	return "written"
+
+
+# check whether the file in filepath has exactly the given content,
+# comparing sizes first and SHA-256 hashes only if they match
+def file_has_content(filepath, content: bytes) -> bool:
+	try:
+		if os.path.getsize(filepath) != len(content):
+			return False
+		file_hash = hashlib.sha256()
+		with open(filepath, "rb") as existing_file:
+			for chunk in iter(lambda: existing_file.read(1024 * 1024), b""):
+				file_hash.update(chunk)
+	except OSError:
+		return False
+	return file_hash.digest() == hashlib.sha256(content).digest()
 
 
 def print_exe_header():
@@ -818,4 +1985,6 @@ def print_exe_header():
 
 # Run main script function
 if __name__ == "__main__":
+	# Needed for worker processes in executables built with pyinstaller
+	multiprocessing.freeze_support()
 	main()